@@ -8,6 +8,22 @@ But if you need to build multiple you face a problem. You can have incomplete
 versions uploaded with only some wheels if your projects lack tests.
 I really don't like taking that chance. So, this project was born.
 
+The config is read from .wheelman.yml by default. It can also be written as
+TOML, which doesn't need PyYAML and is quicker to load. To switch, convert
+the file to TOML with the same keys and point --config-file at it:
+
+    name = "mypackage"
+    include_files = ["README.md", "LICENSE"]
+
+    [[targets.release]]
+    python = "C:/Python38/python.exe"
+    wheel = true
+
+    [pypi]
+    target_url = "https://pypi.org/legacy/"
+
+Anything that doesn't end in .toml is still read as YAML.
+
 MIT License
 
 Copyright (c) 2020 Michelle van der Graaf
@@ -31,7 +47,9 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-print('\n\n' + '*'*80)
+BANNER = '\n\n' + '*'*80
+
+print(BANNER)
 print('* Initializing Wheelman.')
 
 class ExitCodes:
@@ -41,6 +59,8 @@ class ExitCodes:
     MISSING_DEPENDENCIES = 10
     CONFIG_FILE_NOT_FOUND = 11
     CONFIG_YAML_PARSING_ERROR = 12
+    CONFIG_TOML_PARSING_ERROR = 13
+    CONFIG_MISSING_TARGET = 14
 
     BUILD_FAILED_WHEEL = 20
     BUILD_FAILED_SOURCE_DIST = 21
@@ -53,17 +73,25 @@ class ExitCodes:
 
 import os
 import sys
+
+# Flush on every line so our output stays in order with the output of the
+# commands we run, without having to flush by hand after every print.
+sys.stdout.reconfigure(line_buffering=True)
+
 import shutil
+import json
+import importlib.util
 
 from argparse import ArgumentParser
 from traceback import format_exc
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 try:
-    import yaml
-    from subprocess import run
+    from subprocess import run, Popen, PIPE, STDOUT, CalledProcessError
 except ImportError:
     print(format_exc())
-    exit(ExitCodes.ERROR_MISSING_DEPENDENCIES)
+    exit(ExitCodes.MISSING_DEPENDENCIES)
 except Exception:
     print(format_exc())
     exit(ExitCodes.UNSPECIFIED)
@@ -80,7 +108,8 @@ parser.add_argument(
     required=True)
 parser.add_argument(
     '--config-file',
-    help='What file to read the config from.',
+    help='What file to read the config from. Files ending in .toml are '
+         'read as TOML, anything else as YAML.',
     default=".wheelman.yml")
 args = parser.parse_args()
 
@@ -89,85 +118,422 @@ args = parser.parse_args()
 
 print('* Loading config file from %s' % args.config_file)
 
-config = {}
+def load_yaml_config(path):
+    '''
+    Loads the config from a YAML file. Exits if it can't be loaded.
+    '''
+    try:
+        import yaml
+        # The libyaml backed loader is a lot faster, but not every build
+        # image has libyaml available. So fall back to the pure python one.
+        try:
+            from yaml import CSafeLoader as _Loader
+        except ImportError:
+            from yaml import SafeLoader as _Loader
+    except ImportError:
+        print(format_exc())
+        exit(ExitCodes.MISSING_DEPENDENCIES)
 
-try:
-    with open(args.config_file) as config:
-        config = yaml.load(config.read(), Loader=yaml.Loader)
+    try:
+        with open(path, 'rb') as f:
+            return yaml.load(f, Loader=_Loader)
+
+    except yaml.YAMLError as exc:
+        print('* ERROR: Config YAML parsing failure.')
+
+        if hasattr(exc, 'problem_mark'):
+            mark = exc.problem_mark
+            print('* At position: (%s:%s)' % (mark.line+1, mark.column+1))
 
-except (yaml.YAMLError, exc):
-    print('* ERROR: Config YAML parsing failure.')
+        exit(ExitCodes.CONFIG_YAML_PARSING_ERROR)
 
-    if hasattr(exc, 'problem_mark'):
-        mark = exc.problem_mark
-        print('* At position: (%s:%s)' % (mark.line+1, mark.column+1))
+    except OSError:
+        print("* ERROR: Couldn't load config file.")
+        exit(ExitCodes.CONFIG_FILE_NOT_FOUND)
 
-    exit(ExitCodes.CONFIG_YAML_PARSING_ERROR)
+def load_toml_config(path):
+    '''
+    Loads the config from a TOML file. Exits if it can't be loaded.
+    '''
+    # tomllib only exists from python 3.11. tomli is the same thing for before.
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            print(format_exc())
+            exit(ExitCodes.MISSING_DEPENDENCIES)
+
+    try:
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+
+    except tomllib.TOMLDecodeError as exc:
+        print('* ERROR: Config TOML parsing failure.')
+        print('* %s' % exc)
+        exit(ExitCodes.CONFIG_TOML_PARSING_ERROR)
+
+    except OSError:
+        print("* ERROR: Couldn't load config file.")
+        exit(ExitCodes.CONFIG_FILE_NOT_FOUND)
+
+config = None
+
+# A parsed copy of the config is kept next to it so we don't need to parse
+# it again on every run. It's keyed on the mtime and size of the config
+# file so any edit to the config invalidates it.
+#
+# The cache is written as <config file>.cache right beside your config, so
+# add it to your .gitignore. It's plain JSON rather than pickle so that a
+# cache file that ended up in the checkout can't run any code when read.
+cache_file = '%s.cache' % args.config_file
+cache_key = None
+
+try:
+    config_stat = os.stat(args.config_file)
+    cache_key = [config_stat.st_mtime_ns, config_stat.st_size]
+
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        cache = json.load(f)
 
+    if cache['key'] == cache_key:
+        config = cache['config']
+        print('* Using cached config from %s' % cache_file)
+# A missing or broken cache just means we parse the config like normal.
 except Exception:
-    print("* ERROR: Couldn't load config file.")
-    exit(ExitCodes.CONFIG_FILE_NOT_FOUND)
+    pass
+
+if config is None:
+    if args.config_file.endswith('.toml'):
+        config = load_toml_config(args.config_file)
+    else:
+        config = load_yaml_config(args.config_file)
+
+    # Not being able to write the cache shouldn't stop the build.
+    # Configs that don't survive a trip through JSON unchanged, like ones
+    # with dates or non string keys, just don't get cached.
+    if cache_key is not None:
+        try:
+            cache = json.dumps({'key': cache_key, 'config': config})
+            if json.loads(cache)['config'] == config:
+                with open(cache_file, 'w', encoding='utf-8') as f:
+                    f.write(cache)
+        except Exception:
+            pass
+
+
+### Config validation.
+
+# Everything we need to know is checked here, before any building happens.
+# That way a broken config or environment fails right away instead of after
+# all the wheels are built.
+
+pkg_name = config['name']
+include_files = config['include_files']
+
+if args.target not in config['targets']:
+    print('* ERROR: Target %s is not in the config.' % args.target)
+    exit(ExitCodes.CONFIG_MISSING_TARGET)
+
+targets = config['targets'][args.target]
+
+pypi_config = config.get("pypi", {})
+
+# You can't just go and upload every commit whilly nilly, default should only
+# upload for releases.
+only_tags = pypi_config.get('only_upload_tags', True)
+is_tag = os.environ.get('APPVEYOR_REPO_TAG', 'false') == 'true'
+
+pypi_username = os.environ.get('TWINE_USERNAME', None)
+pypi_password = os.environ.get('TWINE_PASSWORD', None)
+
+if (pypi_username is None) != (pypi_password is None):
+    # If only a username or a password is supplied we can be sure something
+    # is fishy.
+    print("* ERROR: Only a username or password supplied for pypi")
+    exit(ExitCodes.PYPI_MISSING_ENVIRONMENT_VARS)
+
+do_upload = (
+    # Only even attempt to upload if we have the right environment vars to do so
+    (pypi_username is not None) and
+    # Only upload if on a tag if only_upload_tags is true.
+    # Upload either way if not.
+    ((only_tags and is_tag) or (not only_tags)))
+
+pypi_url = pypi_config.get('target_url', '')
+
+if do_upload and not pypi_url:
+    print('* ERROR: Missing pypi->target_url value in build.yml.')
+    exit(ExitCodes.PYPI_MISSING_CONFIG_VARS)
+
+
+### Subprocess helpers.
+
+# Builds run at the same time, so everything they print goes through say()
+# with the target it belongs to in front of every line. The lock keeps lines
+# from different builds from getting mixed together.
+print_lock = Lock()
+real_stdout = sys.stdout
+
+def say(prefix, text):
+    '''
+    Prints every line of text with prefix in front of it.
+    '''
+    with print_lock:
+        for line in text.split('\n'):
+            print(prefix + line, file=real_stdout)
+
+class PrefixedWriter:
+    '''
+    File-like object that passes everything written to it on to say().
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.pending = ''
+
+    def write(self, text):
+        lines = (self.pending + text).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            say(self.prefix, line.rstrip('\r'))
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            say(self.prefix, self.pending)
+            self.pending = ''
+
+    def isatty(self):
+        return False
+
+def run_logged(cmd, prefix):
+    '''
+    Runs the given command with prefix in front of every line of its output.
+    Raises CalledProcessError if it fails, like run() with check=True.
+    '''
+    # Unbuffered so python children don't hold their output back until exit.
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    with Popen(cmd, stdout=PIPE, stderr=STDOUT, env=env,
+               text=True, errors='replace') as proc:
+        for line in proc.stdout:
+            say(prefix, line.rstrip('\r\n'))
+
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd)
+
+def sh(cmd, fail_code, fail_message=None, prefix=None):
+    '''
+    Runs the given command and exits with fail_code if it fails.
+
+    If a prefix is given it's put in front of every line of output.
+    '''
+    try:
+        if prefix is None:
+            run(cmd, check=True)
+        else:
+            run_logged(cmd, prefix)
+    except CalledProcessError:
+        if fail_message is not None:
+            say(prefix or '', fail_message)
+        exit(fail_code)
+
+
+### Pip set up.
+
+# On appveyor pip gets pointed at a cache folder inside the build folder so
+# downloaded packages can be kept between builds. To make appveyor keep it
+# around add it to the cache section of your appveyor.yml:
+#
+#     cache:
+#       - .pipcache
+#
+# The folder ends up in your project root, so also add .pipcache to your
+# .gitignore and make sure your MANIFEST.in doesn't pull it into the sdist.
+# Outside of appveyor pip just uses its normal cache.
+if 'APPVEYOR_BUILD_FOLDER' in os.environ:
+    PIP_CACHE_ARGS = ['--cache-dir', os.path.join(
+        os.environ['APPVEYOR_BUILD_FOLDER'], '.pipcache')]
+else:
+    PIP_CACHE_ARGS = []
+
+# Running pip inside of this process changes process wide state while it
+# runs. It swaps out os.environ's PATH and PYTHONPATH for its build
+# environments and changes the umask, which any subprocess started by
+# another thread at that moment would pick up. So pip is only run in here
+# while no other builds are running, and set to False while they are.
+in_process_pip = True
+
+def python_path(py_exe):
+    '''
+    Returns the normalized path of the given python executable.
+
+    Symlinks are deliberately not resolved. A venv's python is a symlink to
+    the python it was made from, but it has its own site-packages.
+    '''
+    return os.path.normcase(os.path.abspath(shutil.which(py_exe) or py_exe))
+
+def is_current_python(py_exe):
+    '''
+    Returns whether the given python executable is the one running this script.
+    '''
+    return python_path(py_exe) == python_path(sys.executable)
+
+def has_module(py_exe, module):
+    '''
+    Returns whether the given python executable can import the given module.
+    '''
+    if is_current_python(py_exe):
+        importlib.invalidate_caches()
+        return importlib.util.find_spec(module) is not None
+
+    return run([py_exe, '-c', 'import %s' % module],
+               capture_output=True).returncode == 0
+
+def pip_install(py_exe, *pip_args, fail_message=None, prefix=None):
+    '''
+    Runs pip install for the given python executable and exits with
+    PIP_FAILURE if it fails.
+
+    If the python is the one running this script, and no other builds are
+    running, pip is run from in here to save us from starting up another
+    interpreter. If a prefix is given it's put in front of every line of
+    pip's output.
+    '''
+    install_args = ['install', *PIP_CACHE_ARGS, *pip_args]
+
+    pip_main = None
+    if in_process_pip and is_current_python(py_exe):
+        try:
+            from pip._internal.cli.main import main as pip_main
+        except ImportError:
+            pass
+
+    if pip_main is None:
+        sh([py_exe, '-m', 'pip', *install_args],
+           ExitCodes.PIP_FAILURE, fail_message, prefix)
+        return
+
+    if prefix is None:
+        returncode = pip_main(install_args)
+    else:
+        # pip writes to whatever sys.stdout and sys.stderr are when it starts.
+        writer = PrefixedWriter(prefix)
+        old_streams = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = writer
+        try:
+            returncode = pip_main(install_args)
+        finally:
+            sys.stdout, sys.stderr = old_streams
+            writer.flush()
+
+    if returncode != 0:
+        if fail_message is not None:
+            say(prefix or '', fail_message)
+        exit(ExitCodes.PIP_FAILURE)
+
+
+### Filesystem helpers.
+
+def remove_tree(path):
+    '''
+    Deletes a folder and everything in it. Does nothing if it doesn't exist.
+
+    Anything else that goes wrong, like a permission error, is raised.
+    '''
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
 
 
 ### Preparatory cleanup.
 
-print('\n\n' + '*'*80)
+print(BANNER)
 print('* Prepping environment.')
 
-try:
-    print('* Deleting potential leftover dist folder.')
-    # Just in case for if this is a persistent VM.
-    # This is the folder that we upload stuff to pypi from.
-    # We want it clean.
-    shutil.rmtree("dist")
-# TODO: This error should be made specific to if the file was not found.
-# Right now a permission error could easily slip through this.
-except Exception:
-    pass
+print('* Deleting potential leftover dist folder.')
+# Just in case for if this is a persistent VM.
+# This is the folder that we upload stuff to pypi from.
+# We want it clean.
+remove_tree("dist")
 
 
 ### Copy the include files into the package.
 
-for name in config['include_files']:
-    print('* Copying file %s into folder %s' % (name, config['name']))
-    shutil.copyfile(name, "%s/%s" % (config['name'], name))
+for name in include_files:
+    print('* Copying file %s into folder %s' % (name, pkg_name))
+    dest = f"{pkg_name}/{name}"
+
+    # Get rid of the copy from a previous run so we can link over it.
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    # A hardlink saves us from copying the whole file, but can't cross
+    # filesystems and isn't supported everywhere. So copy if it fails.
+    try:
+        os.link(name, dest)
+    except OSError:
+        shutil.copyfile(name, dest)
 
 
 ### Build our targets!
 
-for target in config['targets'].get(args.target, ()):
+def build_target(index, target):
+    '''
+    Builds the sdist and/or wheel for a single target.
+
+    Every target gets its own build and dist folders. Wheel only targets also
+    get their own egg-info folder so they can be built at the same time
+    without stepping on each other's files. Targets doing an sdist use the
+    regular egg-info folder, as that ends up inside the sdist, so they can't
+    be built alongside other sdist targets.
+
+    Everything printed is prefixed with the target's python so output from
+    builds running at the same time can be told apart.
+
+    Exits with the matching exit code if anything fails. When run from the
+    thread pool that exit gets raised again in the main thread.
+    '''
+    py_exe = target['python']
+    work_dir = os.path.join("build", "wheelman", "target%d" % index)
+    dist_dir = os.path.join("dist", "target%d" % index)
+    prefix = '[%s] ' % py_exe
+
     # It's a good idea to clean this info up before we do anything else.
     # The files might clash with each other because of different features
     # between python versions.
-    print('\n\n' + '*'*80)
-    print('* Cleaning up egg-info.')
-    sys.stdout.flush()
+    say(prefix, BANNER)
+    say(prefix, '* Cleaning up build folder for %s.' % (py_exe))
 
     try: # It's not mission critical that this succeeds.
-         # And the first loop these files shouldn't exist.
+         # And the first run these files shouldn't exist.
          # So we try catch to avoid adding more logic.
-        shutil.rmtree("%s.egg-info" % config['name'])
+        remove_tree(work_dir)
     except Exception:
         pass
 
-    py_exe = target['python']
-    print('\n\n' + '*'*80)
-    print('* Preparing environment for %s now.' % (py_exe))
-    sys.stdout.flush()
+    # The cleanup above may have left part of the folder behind.
+    os.makedirs(work_dir, exist_ok=True)
 
-    if run([py_exe, '-m', 'pip', 'install', 'wheel']).returncode != 0:
-        exit(ExitCodes.PIP_FAILURE)
+    say(prefix, BANNER)
+    say(prefix, '* Preparing environment for %s now.' % (py_exe))
 
-    print('\n\n' + '*'*80)
-    print('* Getting requirements.')
+    if not has_module(py_exe, 'wheel'):
+        pip_install(py_exe, 'wheel', prefix=prefix)
+
+    say(prefix, BANNER)
+    say(prefix, '* Getting requirements for %s.' % (py_exe))
 
     if os.path.exists("requirements.txt"):
-        if run([py_exe, '-m', 'pip', 'install', '-r', 'requirements.txt']).returncode != 0:
-            exit(ExitCodes.PIP_FAILURE)
+        pip_install(py_exe, '-r', 'requirements.txt', prefix=prefix)
+
+    say(prefix, BANNER)
+    say(prefix, '* Building for %s now.' % (py_exe))
 
-    print('\n\n' + '*'*80)
-    print('* Building for %s now.' % (py_exe))
-    sys.stdout.flush()
+    # Both distributions are done in one setup.py run so we only pay for
+    # starting python and importing setuptools once.
+    cmds = []
 
     # It is suggested to only enable sdist for the highest python version.
     # Because:
@@ -176,100 +542,140 @@ for target in config['targets'].get(args.target, ()):
     #     3. Older versions such as python 3.5 don't understand the arguments
     #        required for markdown descriptions.
 
-    if target.get('sdist', False):
-        print('* Doing a source distribution!')
-        sys.stdout.flush()
-        if run([py_exe, 'setup.py', 'sdist']).returncode != 0:
-            print("Failed to build source dist for %s" % py_exe)
-            exit(ExitCodes.BUILD_FAILED_SOURCE_DIST)
+    do_sdist = target.get('sdist', False)
+    if do_sdist:
+        say(prefix, '* Doing a source distribution for %s!' % py_exe)
+        # The egg-info goes into the sdist, so it has to be in the normal
+        # spot and fresh, like it would be for a plain setup.py sdist.
+        remove_tree("%s.egg-info" % pkg_name)
+        cmds += ['sdist', '--dist-dir', dist_dir]
+    else:
+        cmds += ['egg_info', '--egg-base', work_dir]
 
     # Wheels should be built for every available version that you support.
     # Python <=3.5 is known to crash in online windows build environments
     # because of missing dependencies and microsoft breaking old visual studios.
 
-    if target.get('wheel', False):
-        print('* Doing a wheel!')
-        sys.stdout.flush()
-        if run([py_exe, 'setup.py', 'bdist_wheel']).returncode != 0:
-            print("Failed to build wheel for %s" % py_exe)
-            exit(ExitCodes.BUILD_FAILED_WHEEL)
+    do_wheel = target.get('wheel', False)
+    if do_wheel:
+        say(prefix, '* Doing a wheel for %s!' % py_exe)
+        cmds += ['build', '--build-base', work_dir,
+                 'bdist_wheel', '--dist-dir', dist_dir]
 
+    if not (do_sdist or do_wheel):
+        return
 
-### Pypi stuff
+    try:
+        run_logged([py_exe, 'setup.py', *cmds], prefix)
+    except CalledProcessError:
+        # The sdist is done first, so if it's not there that's what failed.
+        built = os.listdir(dist_dir) if os.path.isdir(dist_dir) else ()
+        if do_sdist and not any(
+                name.endswith(('.tar.gz', '.zip')) for name in built):
+            say(prefix, "Failed to build source dist for %s" % py_exe)
+            exit(ExitCodes.BUILD_FAILED_SOURCE_DIST)
 
-pypi_config = config.get("pypi", {})
+        say(prefix, "Failed to build wheel for %s" % py_exe)
+        exit(ExitCodes.BUILD_FAILED_WHEEL)
 
-# You can't just go and upload every commit whilly nilly, default should only
-# upload for releases.
-only_tags = pypi_config.get('only_upload_tags', True)
-is_tag = os.environ.get('APPVEYOR_REPO_TAG', 'false') == 'true'
 
-# Do an upload if we have the right info!
+def build_targets(group):
+    '''
+    Builds the given (index, target) pairs one after another.
+    '''
+    for index, target in group:
+        build_target(index, target)
 
-pypi_username = os.environ.get('TWINE_USERNAME', None)
-pypi_password = os.environ.get('TWINE_PASSWORD', None)
 
-if (# Only even attempt to upload if we have the right environment vars to do so
-    (pypi_username is not None) and
-    (pypi_password is not None) and
-    # Only upload if on a tag if only_upload_tags is true.
-    # Upload either way if not.
-    ((only_tags and is_tag) or (not only_tags))):
+# Wheel targets are grouped by python. Targets on the same python would
+# otherwise be pip installing into the same site-packages at the same time,
+# so the targets in a group are built one after another.
+sdist_targets = []
+wheel_groups = {}
+for index, target in enumerate(targets):
+    if target.get('sdist', False):
+        sdist_targets.append((index, target))
+    else:
+        wheel_groups.setdefault(
+            python_path(target['python']), []).append((index, target))
 
-    print('\n\n' + '*'*80)
-    print('* Preparing to upload to twine.')
-    print('* Ensuring that twine is installed.')
-    sys.stdout.flush()
+# The sdist targets all use the same egg-info and release folders in the
+# project root, so those get done one by one before the rest.
+build_targets(sdist_targets)
 
-    pypi_url = pypi_config.get('target_url', '')
+# The builds are mostly waiting on subprocesses, so threads are plenty.
+if wheel_groups:
+    # With a single group there's nothing running alongside it, so it's
+    # still safe to run pip in here for it.
+    in_process_pip = len(wheel_groups) == 1
 
-    if not pypi_url:
-        print('* ERROR: Missing pypi->target_url value in build.yml.')
-        exit(ExitCodes.PYPI_MISSING_CONFIG_VARS)
+    with ThreadPoolExecutor(max_workers=min(
+            len(wheel_groups), os.cpu_count() or 1)) as executor:
+        futures = [executor.submit(build_targets, group)
+                   for group in wheel_groups.values()]
 
-    # Install twine if we don't have it.
-    if run([py_exe, '-m', 'pip', 'install', 'twine']).returncode != 0:
-        print('* ERROR: Failed to ensure that twine is installed.')
-        exit(ExitCodes.PIP_FAILURE)
+        # Getting the results is what raises any exits from the builds.
+        for future in futures:
+            future.result()
 
-    # Some build environments don't properly add pip installed packages to PATH
-    # So, this is so we can execute using the direct path.
-    try:
-        from twine.__main__ import __file__ as twine_py
-    except ImportError:
-        print("* ERROR: Couldn't import twine.")
-        exit(ExitCodes.ERROR_MISSING_DEPENDENCIES)
+    in_process_pip = True
 
-    py_exe = sys.executable
+# Gather everything into dist so it can all be uploaded in one go.
+for index in range(len(targets)):
+    dist_dir = os.path.join("dist", "target%d" % index)
+    if not os.path.isdir(dist_dir):
+        continue
 
-    print('\n\n' + '*'*80)
-    print('* Uploading to %s with username %s.' % (pypi_url, pypi_username))
-    print('* Using twine located at %s.' % (twine_py))
-    sys.stdout.flush()
+    for name in os.listdir(dist_dir):
+        shutil.move(os.path.join(dist_dir, name), os.path.join("dist", name))
 
-    if pypi_url == "https://pypi.org/legacy/":
-        pypi_url = "https://upload.pypi.org/legacy/"
+    os.rmdir(dist_dir)
 
-    if run([py_exe, twine_py, "upload",
-            # Let's not lock up our hands off build environment now.
-            "--non-interactive",
-            "--repository-url", pypi_url,
-            "dist/*"]).returncode != 0:
-        exit(ExitCodes.PYPI_UPLOAD_FAILURE)
 
-elif (((pypi_username is None) or (pypi_password is None)) and
-    pypi_username != pypi_password):
-    # If only a username or a password is supplied we can be sure something
-    # is fishy.
-    print("* ERROR: Only a username or password supplied for pypi")
-    sys.stdout.flush()
-    exit(ExitCodes.PYPI_MISSING_ENVIRONMENT_VARS)
+### Pypi stuff
 
-else:
+if not do_upload:
     # Still inform people to be nice.
-    print('\n\n' + '*'*80)
+    print(BANNER)
     print('* INFO: Not uploading to pypi.')
-    sys.stdout.flush()
+    exit(ExitCodes.SUCCESS)
+
+# Do an upload since we have the right info!
+
+print(BANNER)
+print('* Preparing to upload to twine.')
+print('* Ensuring that twine is installed.')
+
+# Install twine if we don't have it.
+if not has_module(sys.executable, 'twine'):
+    pip_install(sys.executable, 'twine', fail_message=
+                '* ERROR: Failed to ensure that twine is installed.')
+
+# Twine is run from in here. That way we don't need to start up another
+# interpreter, and we don't depend on pip putting twine on the PATH.
+try:
+    from twine import cli as twine_cli
+except ImportError:
+    print("* ERROR: Couldn't import twine.")
+    exit(ExitCodes.MISSING_DEPENDENCIES)
+
+print(BANNER)
+print('* Uploading to %s with username %s.' % (pypi_url, pypi_username))
+print('* Using twine located at %s.' % (twine_cli.__file__))
+
+if pypi_url == "https://pypi.org/legacy/":
+    pypi_url = "https://upload.pypi.org/legacy/"
+
+try:
+    twine_cli.dispatch(["upload",
+        # Let's not lock up our hands off build environment now.
+        "--non-interactive",
+        "--repository-url", pypi_url,
+        "dist/*"])
+except (Exception, SystemExit):
+    print(format_exc())
+    print('* ERROR: Failed to upload to pypi.')
+    exit(ExitCodes.PYPI_FAILURE)
 
 
 exit(ExitCodes.SUCCESS)